@@ -1,9 +1,161 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from processing import analyze_image
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import List, Optional
+from processing import (analyze_image, analyze_image_file, init_pool_worker,
+                        warmup, _error)
+import asyncio
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
 import traceback
+import uuid
 
-app = FastAPI(title="Luminol Image Analysis API")
+# Uploads by token (POST /upload): the frontend sends each photo once, then
+# /analyze and /preview reference it by token instead of re-uploading on
+# every slider move.  Tokens expire UPLOAD_TTL_SECONDS after last use.
+#
+# The store is per-process memory: run the API as a single process (no
+# `uvicorn --workers N`).  With several workers a token is only known to
+# the one that issued it, and calls landing elsewhere get a 404, which the
+# frontend answers by uploading the image again.
+UPLOAD_TTL_SECONDS = 15 * 60
+UPLOAD_STORE_SIZE  = 64
+
+_upload_store      = OrderedDict()   # token → [expires_at, image_bytes, overlay]
+_upload_store_lock = threading.Lock()
+
+
+def _get_upload_entry(token):
+    """Live store entry for token (refreshing its expiry), else None.
+    Caller holds _upload_store_lock."""
+    now = time.monotonic()
+    entry = _upload_store.get(token)
+    if entry is None or entry[0] < now:
+        _upload_store.pop(token, None)
+        return None
+    entry[0] = now + UPLOAD_TTL_SECONDS
+    _upload_store.move_to_end(token)
+    return entry
+
+
+def _get_upload(token):
+    with _upload_store_lock:
+        entry = _get_upload_entry(token)
+        return entry[1] if entry is not None else None
+
+
+# Overlays are served from memory (GET /overlay/{key}) rather than inlined
+# as base64 in the JSON.  A request made with an upload token keeps its
+# overlay in that upload's single slot, replaced by each newer analysis, so
+# it lives exactly as long as the upload.  Requests without a token (plain
+# multipart, /analyze_batch) go to a small LRU of OVERLAY_STORE_SIZE.
+# Like the upload store this is per-process memory, so it too needs the
+# API to run as a single process.
+OVERLAY_STORE_SIZE = 256
+
+_overlay_store      = OrderedDict()
+_overlay_store_lock = threading.Lock()
+_overlay_versions   = itertools.count()
+
+
+def _publish_overlay(result, token=None):
+    """Move the overlay bytes out of an analyze_image result into a store,
+    replacing them with the URL that serves them."""
+    overlay = result.pop("overlay_webp", None)
+    result["overlay_url"] = None
+    if overlay is None:
+        return result
+
+    # The version query makes each replacement a new URL for the browser
+    version = next(_overlay_versions)
+    if token:
+        with _upload_store_lock:
+            entry = _get_upload_entry(token)
+            if entry is not None:
+                entry[2] = overlay
+                result["overlay_url"] = f"/overlay/{token}?v={version}"
+                return result
+
+    key = uuid.uuid4().hex
+    with _overlay_store_lock:
+        _overlay_store[key] = overlay
+        while len(_overlay_store) > OVERLAY_STORE_SIZE:
+            _overlay_store.popitem(last=False)
+    result["overlay_url"] = f"/overlay/{key}?v={version}"
+    return result
+
+
+async def _read_image(image, token):
+    """Image bytes from an upload token, or from the multipart file."""
+    if token:
+        contents = _get_upload(token)
+        if contents is None:
+            raise HTTPException(status_code=404, detail="Upload token expired or unknown")
+        return contents
+    if image is None:
+        raise HTTPException(status_code=400, detail="Send an image file or an upload token")
+    return await image.read()
+
+
+def _new_batch_executor():
+    # Worker pool for /analyze_batch.  "spawn" rather than fork: the server
+    # process already runs threads (event loop helpers, threadpool, numba).
+    # Workers run single-threaded internally (one image per core) and warm
+    # up as they start.
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_pool_worker,
+    )
+
+
+_batch_executor_lock = threading.Lock()
+
+
+def _spool_upload(upload):
+    """
+    Copy an upload to a named temp file.  Batch workers read images by
+    path: pickling whole images through the pool's pipe can leave its
+    manager thread blocked on a full pipe when a worker dies, which then
+    hangs interpreter exit.
+    """
+    with tempfile.NamedTemporaryFile(prefix="luminol-batch-", delete=False) as f:
+        shutil.copyfileobj(upload.file, f)
+        return f.name
+
+
+def _renew_batch_executor(app, broken):
+    """
+    A worker that dies (OOM, native crash) breaks its whole pool: every
+    pending and later submit raises BrokenProcessPool.  Swap in a fresh
+    pool — once, however many requests notice the same broken one.
+    """
+    with _batch_executor_lock:
+        if app.state.batch_executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            app.state.batch_executor = _new_batch_executor()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pay first-call initialisation before serving, not on the first request
+    await run_in_threadpool(warmup)
+    app.state.batch_executor = _new_batch_executor()
+    yield
+    app.state.batch_executor.shutdown(cancel_futures=True)
+
+
+app = FastAPI(title="Luminol Image Analysis API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -14,20 +166,50 @@ app.add_middleware(
 )
 
 
+@app.post("/upload")
+async def upload_endpoint(image: UploadFile = File(...)):
+    """Store an image for later /analyze and /preview calls by token."""
+    contents = await image.read()
+    token = uuid.uuid4().hex
+    now = time.monotonic()
+    with _upload_store_lock:
+        _upload_store[token] = [now + UPLOAD_TTL_SECONDS, contents, None]
+        while _upload_store and (len(_upload_store) > UPLOAD_STORE_SIZE
+                                 or next(iter(_upload_store.values()))[0] < now):
+            _upload_store.popitem(last=False)
+    return {"token": token, "expires_in": UPLOAD_TTL_SECONDS}
+
+
 @app.post("/analyze")
 async def analyze_endpoint(
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
+    token: Optional[str] = Form(None),
     shutter_seconds: float = Form(0),
     exposure_time: float = Form(0),       # legacy alias
     iso: float = Form(0),
     sensitivity: float = Form(50),
     capture_mode: str = Form("jpeg"),
+    high_quality: bool = Form(False),
+    want_overlay: bool = Form(True),
+    want_debug_image: bool = Form(False),
 ):
+    """
+    The frontend only shows debug_image when no overlay is present, so the
+    legacy contour JPEG is opt-in here.  Batch clients that only need
+    metrics can also skip the overlay.  Send either the image or a token
+    from /upload.  high_quality denoises JPEGs with NL-means instead of the
+    bilateral filter (see debug_info.denoiser).
+    """
     t = shutter_seconds if shutter_seconds > 0 else exposure_time
+    contents = await _read_image(image, token)
     try:
-        contents = await image.read()
-        result = analyze_image(contents, t, iso, sensitivity, capture_mode)
-        return result
+        # CPU-bound — run in the threadpool so the event loop stays free
+        result = await run_in_threadpool(
+            analyze_image, contents, t, iso, sensitivity, capture_mode,
+            high_quality=high_quality,
+            want_overlay=want_overlay, want_debug_image=want_debug_image,
+        )
+        return _publish_overlay(result, token)
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
@@ -35,27 +217,112 @@ async def analyze_endpoint(
 
 @app.post("/preview")
 async def preview_endpoint(
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
+    token: Optional[str] = Form(None),
     shutter_seconds: float = Form(0),
     exposure_time: float = Form(0),
     iso: float = Form(0),
     sensitivity: float = Form(50),
     capture_mode: str = Form("jpeg"),
+    high_quality: bool = Form(False),
 ):
     """
     Same computation as /analyze — separate endpoint for semantic clarity.
-    Frontend calls this on per-image slider changes (debounced).
+    Frontend calls this on per-image slider changes (debounced), and only
+    needs the RGBA overlay, so the debug JPEG is never encoded.  Takes an
+    /upload token like /analyze, so slider moves send no image data.
     """
     t = shutter_seconds if shutter_seconds > 0 else exposure_time
+    contents = await _read_image(image, token)
     try:
-        contents = await image.read()
-        result = analyze_image(contents, t, iso, sensitivity, capture_mode)
-        return result
+        result = await run_in_threadpool(
+            analyze_image, contents, t, iso, sensitivity, capture_mode,
+            high_quality=high_quality,
+            want_overlay=True, want_debug_image=False,
+        )
+        return _publish_overlay(result, token)
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/analyze_batch")
+async def analyze_batch_endpoint(
+    images: List[UploadFile] = File(...),
+    shutter_seconds: float = Form(0),
+    exposure_time: float = Form(0),
+    iso: float = Form(0),
+    sensitivity: float = Form(50),
+    capture_mode: str = Form("jpeg"),
+    want_overlay: bool = Form(False),
+):
+    """
+    Analyse several images with shared settings, fanned out across worker
+    processes.  A failing image gets an error entry instead of failing the
+    whole batch.  Overlays are off by default — batches are metrics runs.
+    """
+    t = shutter_seconds if shutter_seconds > 0 else exposure_time
+    loop = asyncio.get_running_loop()
+    job = partial(analyze_image_file, want_overlay=want_overlay, want_debug_image=False)
+
+    async def run(path):
+        executor = app.state.batch_executor
+        try:
+            return await loop.run_in_executor(executor, job,
+                                              path, t, iso, sensitivity, capture_mode)
+        except BrokenProcessPool:
+            _renew_batch_executor(app, executor)
+            raise
+
+    # Submit each image as soon as it is spooled to disk, so spooling the
+    # next upload overlaps with workers already analysing earlier ones.
+    paths, tasks = [], []
+    try:
+        for image in images:
+            paths.append(await run_in_threadpool(_spool_upload, image))
+            tasks.append(asyncio.ensure_future(run(paths[-1])))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        # A crashed worker fails every image still pending in its pool.
+        # Retry those one at a time on the fresh pool, so only an image
+        # that crashes a worker by itself is reported as failed.
+        for i, result in enumerate(results):
+            if isinstance(result, BrokenProcessPool):
+                try:
+                    results[i] = await run(paths[i])
+                except Exception as e:
+                    results[i] = e
+    finally:
+        # A worker still reading a file keeps its open handle
+        for path in paths:
+            os.unlink(path)
+
+    out = []
+    for image, result in zip(images, results):
+        if isinstance(result, Exception):
+            traceback.print_exception(result)
+            message = str(result)
+            if isinstance(result, BrokenProcessPool):
+                message = "Worker process crashed while analysing this image"
+            result = _error("ANALYSIS_FAILED", message)
+        out.append({"filename": image.filename, **_publish_overlay(result)})
+    return {"results": out}
+
+
+@app.get("/overlay/{key}")
+def overlay_endpoint(key: str):
+    """Latest overlay for an upload token, or a token-less overlay by key."""
+    with _upload_store_lock:
+        entry = _get_upload_entry(key)
+        overlay = entry[2] if entry is not None else None
+    if overlay is None:
+        with _overlay_store_lock:
+            overlay = _overlay_store.get(key)
+    if overlay is None:
+        raise HTTPException(status_code=404, detail="Overlay expired or unknown")
+    return Response(content=overlay, media_type="image/webp")
+
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
@@ -22,7 +22,10 @@ Spill suppression uses a single percentile-cutoff approach:
 import cv2
 import numpy as np
 import base64
-from scipy import ndimage
+import hashlib
+import math
+import threading
+from collections import OrderedDict
 
 # ── Attempt rawpy import (optional — only needed for RAW/DNG mode) ────
 try:
@@ -31,6 +34,31 @@ try:
 except ImportError:
     HAS_RAWPY = False
 
+# ── Attempt numba import (optional — fused mask kernel, NumPy fallback) ─
+try:
+    from numba import njit, prange, set_num_threads
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+# ── Attempt Pillow import (optional — JPEG header/EXIF reads) ──────────
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+# ── Attempt TurboJPEG import (optional — SIMD JPEG decode, cv2 fallback) ─
+# TurboJPEG() raises if the libjpeg-turbo shared library cannot be found.
+# It ignores EXIF orientation, so it is only used when Pillow can read it.
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _TJ = TurboJPEG()   # one instance per process, batch workers included
+    HAS_TURBOJPEG = HAS_PIL
+except (ImportError, OSError, RuntimeError):
+    _TJ = None
+    HAS_TURBOJPEG = False
+
 # ─── Constants ────────────────────────────────────────────────────────
 # Black-box detection (linear space)
 LINEAR_DARK_THRESHOLD   = 0.05
@@ -38,9 +66,34 @@ LINEAR_BRIGHT_THRESHOLD = 0.40
 BB_MIN_DARK_RATIO       = 0.80
 BB_MAX_BRIGHT_RATIO     = 0.25
 
-# Minimum pixel counts
+# Rec.709 luminance weights, as a 1x3 cv2.transform matrix over BGR
+_REC709_LUMA_BGR = np.array([[0.0722, 0.7152, 0.2126]], dtype=np.float32)
+
+# Blue mask: ignore pixels that are essentially black (linear space)
+BLUE_NOISE_FLOOR        = 0.002
+
+# Linear intensities are carried as uint16 scaled so 1.0 → LINEAR_U16_MAX.
+# 16 bits is more than the ~12 the thresholds and percentiles need, and it
+# halves memory traffic against float32.  Metrics are scaled back to [0-1].
+LINEAR_U16_MAX          = 65535
+
+# Minimum pixel counts (full-resolution pixels)
 MIN_BLUE_AREA_PX        = 50
 
+# Analysis resolution: long edge is capped at this many pixels.  Metrics are
+# scalars and the overlay is a preview, so full camera resolution buys nothing.
+MAX_ANALYSIS_DIM        = 1024
+
+# Overlay encoding: lossy WebP, alpha included.  It is only a preview tint.
+OVERLAY_WEBP_QUALITY    = 60
+
+# Legacy debug contour JPEG: a visual check, so lighter than OpenCV's
+# default quality 95.
+DEBUG_JPEG_QUALITY      = 80
+
+# Prepared-stage LRU: number of distinct uploads kept (see _prepare_cached)
+PREPARE_CACHE_SIZE      = 8
+
 # DNG / RAW magic-byte signatures
 _DNG_TIFF_LE = b'\x49\x49\x2a\x00'   # Little-endian TIFF (DNG uses TIFF container)
 _DNG_TIFF_BE = b'\x4d\x4d\x00\x2a'   # Big-endian TIFF
@@ -48,6 +101,25 @@ _DNG_TIFF_BE = b'\x4d\x4d\x00\x2a'   # Big-endian TIFF
 # JPEG signatures
 _JPEG_SOI    = b'\xff\xd8\xff'
 
+# Bytes handed to Pillow to read a JPEG header (EXIF APP1 is at most 64 KB)
+_JPEG_HEADER_PROBE = 256 * 1024
+
+# Encoder parameters, built once
+_OVERLAY_WEBP_PARAMS = [cv2.IMWRITE_WEBP_QUALITY, OVERLAY_WEBP_QUALITY]
+_DEBUG_JPEG_PARAMS   = [cv2.IMWRITE_JPEG_QUALITY, DEBUG_JPEG_QUALITY]
+
+# libjpeg DCT-domain scale factors available through cv2.imdecode; the
+# TurboJPEG path is limited to the same set
+_CV2_REDUCED_FLAGS = {
+    (1, 2): cv2.IMREAD_REDUCED_COLOR_2,
+    (1, 4): cv2.IMREAD_REDUCED_COLOR_4,
+    (1, 8): cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+_prepare_cache      = OrderedDict()
+_prepare_cache_lock = threading.Lock()
+
 
 # ──────────────────────────────────────────────────────────────────────
 # Helpers
@@ -62,6 +134,42 @@ def srgb_to_linear(img_norm):
     return out
 
 
+# 8-bit sRGB code value → linear uint16 (see LINEAR_U16_MAX).  A uint8 image
+# has only 256 possible values, so linearising it is a single gather from
+# this table instead of a per-pixel pow().  Strictly increasing, so code-value
+# order (and hence every threshold and order statistic) is preserved.
+_SRGB8_TO_LIN16 = np.round(
+    srgb_to_linear(np.arange(256, dtype=np.float64) / 255.0) * LINEAR_U16_MAX
+).astype(np.uint16)
+
+
+def _percentile(values, q):
+    """
+    np.percentile(values, q) (default linear interpolation) via introselect.
+    Selects only the two order statistics needed for one quantile, skipping
+    np.percentile's generic n-d setup and extra min/max partition pivots.
+    """
+    pos = (values.size - 1) * (q / 100.0)
+    lo  = int(pos)
+    hi  = min(lo + 1, values.size - 1)
+    part = np.partition(values, (lo, hi))
+    a, b = part[lo], part[hi]
+    t = pos - lo
+    # Same two-sided lerp, in the input dtype, as np.percentile
+    return float(a + (b - a) * t if t < 0.5 else b - (b - a) * (1 - t))
+
+
+def _scalar(src, value):
+    """
+    value as the scalar operand of a cv2 arithmetic/compare call on the
+    single-channel array src.  OpenCV turns a Python scalar into a 4-element
+    array and, for arrays of 4 pixels or fewer, no longer treats it as a
+    scalar ("Sizes of input arguments do not match" on a 1×1 image), so
+    tiny arrays get a same-typed filled array instead.
+    """
+    return np.full_like(src, value) if src.size <= 4 else value
+
+
 def _is_raw_file(data: bytes) -> bool:
     """Heuristic: check if bytes look like a TIFF/DNG container."""
     return data[:4] in (_DNG_TIFF_LE, _DNG_TIFF_BE)
@@ -73,7 +181,8 @@ def _is_jpeg_file(data: bytes) -> bool:
 
 def _decode_raw(image_bytes: bytes):
     """
-    Decode RAW/DNG → linear float32 RGB [0-1].
+    Decode RAW/DNG → linear uint16 BGR, 65535 = 1.0 (same channel order
+    and scale as the linearised JPEG path).
     Returns (img_linear, bit_depth).
     """
     if not HAS_RAWPY:
@@ -90,102 +199,240 @@ def _decode_raw(image_bytes: bytes):
             output_color=rawpy.ColorSpace.sRGB,
         )
         bit_depth = 16
-        img_linear = rgb16.astype(np.float32) / 65535.0
+        img_linear = cv2.cvtColor(rgb16, cv2.COLOR_RGB2BGR)
         return img_linear, bit_depth
     except Exception:
         return None, None
 
 
-def _decode_jpeg(image_bytes: bytes):
-    """
-    Decode JPEG/PNG/TIFF (processed) → linear float32 RGB [0-1].
-    Applies sRGB → linear gamma correction.
-    Returns (img_linear, img_bgr_8bit).
+def _decode_jpeg(image_bytes: bytes, max_dim: int = MAX_ANALYSIS_DIM):
     """
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img_bgr is None:
-        return None, None
-    img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-    img_norm = img_rgb.astype(np.float32) / 255.0
-    img_linear = srgb_to_linear(img_norm)
-    return img_linear, img_bgr
+    Decode JPEG/PNG/TIFF (processed) → 8-bit sRGB BGR.
+    No linearisation here: the linear image is built once, after denoise,
+    via the 8-bit lookup table.
 
+    JPEGs are decoded directly at a reduced size using libjpeg's DCT-domain
+    scaling — the smallest of 1/2, 1/4, 1/8 whose long edge still reaches
+    max_dim — via libjpeg-turbo when available, else cv2.imdecode.  PNG/TIFF
+    decode at full size.
 
-def _keep_best_component_by_sum(mask, score_map, min_area=50):
+    Returns (img_bgr_8bit, (full_h, full_w)), where the second item is the
+    upright full-resolution size, or (None, None) if decoding fails.
     """
-    Keep the connected component with the highest integrated score energy.
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    header = _jpeg_header(image_bytes) if _is_jpeg_file(image_bytes) else None
+
+    if header is not None:
+        width, height, orientation = header
+        full_hw = (height, width) if orientation < 5 else (width, height)
+        # Only the factors cv2 offers, on either decoder, so the analysis
+        # resolution does not depend on whether libjpeg-turbo is installed
+        factor = _dct_scaling_factor(width, height, _CV2_REDUCED_FLAGS, max_dim)
+        if HAS_TURBOJPEG:
+            try:
+                img_bgr = _TJ.decode(image_bytes, pixel_format=TJPF_BGR,
+                                     scaling_factor=factor)
+                return _apply_exif_orientation(img_bgr, orientation), full_hw
+            except Exception:
+                pass
+        img_bgr = cv2.imdecode(nparr, _CV2_REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR))
+        return (img_bgr, full_hw) if img_bgr is not None else (None, None)
 
-    Unlike selecting the component containing the single brightest pixel,
-    this is robust to specular highlights on glass (which are bright but tiny
-    and have low total energy compared to a diffuse glow region).
+    img_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    return (img_bgr, img_bgr.shape[:2]) if img_bgr is not None else (None, None)
 
-    Additionally, thin streak-like components (aspect ratio > 8 and area < 2000 px)
-    are skipped, as they are characteristic of edge reflections rather than glow blobs.
 
-    Parameters
-    ----------
-    mask      : uint8 binary mask (255 = foreground).
-    score_map : float array, same shape as mask. Negative values are clamped to 0.
-    min_area  : components smaller than this are ignored.
+def _jpeg_header(image_bytes: bytes):
+    """
+    (width, height, exif_orientation) from a JPEG header without decoding
+    pixels; width/height are as stored, before orientation.  None if Pillow
+    is unavailable or the header cannot be parsed.
+    """
+    if not HAS_PIL:
+        return None
+    import io
+    # BytesIO copies a non-bytes buffer, so parse a prefix that holds the
+    # markers up to the frame header in practice, and only fall back to
+    # the whole file when it does not.
+    for buf in (image_bytes[:_JPEG_HEADER_PROBE], image_bytes):
+        try:
+            img = Image.open(io.BytesIO(buf))
+            return img.width, img.height, int(img.getexif().get(0x0112, 1))
+        except Exception:
+            if len(buf) == len(image_bytes):
+                return None
+
+
+def _dct_scaling_factor(width, height, factors, max_dim):
+    """Smallest (num, denom) in factors keeping the long edge ≥ max_dim."""
+    long_edge = max(width, height)
+    best = (1, 1)
+    for num, denom in factors:
+        scaled = -(-long_edge * num // denom)        # libjpeg rounds up
+        if num < denom and scaled >= max_dim and num * best[1] < best[0] * denom:
+            best = (num, denom)
+    return best
+
+
+def _apply_exif_orientation(img, orientation):
+    """
+    Rotate/flip a decoded image upright, as cv2.imdecode (and the browser
+    showing the thumbnail) does, so overlays line up with the preview.
+    """
+    if orientation == 2:
+        return cv2.flip(img, 1)
+    if orientation == 3:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(img, 0)
+    if orientation == 5:
+        return cv2.transpose(img)
+    if orientation == 6:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(img), -1)
+    if orientation == 8:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+
+def _footprint_stats(channel, dsize, sat_threshold):
+    """
+    Max and saturation of a single channel over each destination pixel's
+    INTER_AREA footprint when resizing to dsize, so small clipped highlights
+    survive the downscale instead of being averaged away.
+
+    Returns (max_map, sat_frac) at dsize: max_map holds the footprint
+    maximum in the channel's own units; sat_frac (float32, 0-1) the fraction
+    of footprint pixels ≥ sat_threshold.  When no resize is needed each
+    footprint is a single pixel: the channel itself and its 0/1 mask.
+    """
+    src_h, src_w = channel.shape
+    dst_w, dst_h = dsize
+    sat = cv2.compare(channel, _scalar(channel, sat_threshold), cv2.CMP_GE)
+    if (src_h, src_w) == (dst_h, dst_w):
+        sat_frac = sat.astype(np.float32)
+        sat_frac /= 255
+        return channel, sat_frac
+
+    sy, sx = src_h / dst_h, src_w / dst_w
+
+    # A dilation anchored at the kernel's top-left corner turns each pixel
+    # into the max of the block starting there; one block per destination
+    # pixel, starting where its footprint starts, covers that footprint
+    # (plus at most one extra source row/column).
+    kernel = np.ones((math.ceil(sy) + 1, math.ceil(sx) + 1), np.uint8)
+    block_max = cv2.dilate(channel, kernel, anchor=(0, 0))
+    rows = (np.arange(dst_h) * sy).astype(np.intp)
+    cols = (np.arange(dst_w) * sx).astype(np.intp)
+    max_map = block_max[np.ix_(rows, cols)]
+
+    # Area-averaging a 0/1 mask gives the saturated fraction directly
+    sat_frac = cv2.resize(sat.astype(np.float32), dsize,
+                          interpolation=cv2.INTER_AREA)
+    sat_frac /= 255
+    return max_map, sat_frac
+
+
+def _mask_and_stats_numpy(img, dark_t, bright_t, noise_floor):
+    """
+    Fallback for _mask_and_stats when numba is unavailable.  Built from
+    OpenCV's vectorised primitives: one cv2.transform pass for luminance,
+    then compare/countNonZero.  Allocates a float32 copy of the image and
+    the float32 luminance plane, three uint16 planes from cv2.split, and
+    uint8 compare masks — several image-sized temporaries that the numba
+    kernel avoids.
     """
-    labelled, n = ndimage.label(mask > 0)
-    if n == 0:
-        return mask
-    if n == 1:
-        return mask
-
-    score_pos = np.maximum(score_map, 0.0)
-    best_label = -1
-    best_sum   = -1.0
-
-    for lbl in range(1, n + 1):
-        comp = labelled == lbl
-        area = int(np.sum(comp))
-        if area < min_area:
-            continue
-
-        # Shape sanity: skip thin streaks (specular edge reflections)
-        rows = np.any(comp, axis=1)
-        cols = np.any(comp, axis=0)
-        h_span = int(np.sum(rows))
-        w_span = int(np.sum(cols))
-        if h_span > 0 and w_span > 0:
-            aspect = max(h_span, w_span) / max(min(h_span, w_span), 1)
-            if aspect > 8 and area < 2000:
-                continue  # likely a thin edge reflection
-
-        energy = float(np.sum(score_pos[comp]))
-        if energy > best_sum:
-            best_sum   = energy
-            best_label = lbl
-
-    if best_label < 0:
-        # All components were filtered — fall back to returning the original mask
-        return mask
-
-    return ((labelled == best_label) * 255).astype(np.uint8)
-
-
-def _build_overlay_png(core_mask, shape_hw):
+    # Luminance in float32, as the numba kernel computes it: cv2.transform
+    # on the uint16 image would round it to an integer and move pixels
+    # within 0.5 of a threshold to the wrong side.
+    lum = cv2.transform(img.astype(np.float32), _REC709_LUMA_BGR)
+    dark_count   = cv2.countNonZero(
+        cv2.compare(lum, _scalar(lum, float(dark_t)), cv2.CMP_LT))
+    bright_count = cv2.countNonZero(
+        cv2.compare(lum, _scalar(lum, float(bright_t)), cv2.CMP_GT))
+
+    # Channels are integers, so B > noise_floor  ⇔  B > floor(noise_floor)
+    B, G, R = cv2.split(img)
+    blue_mask = cv2.bitwise_and(cv2.compare(B, R, cv2.CMP_GT),
+                                cv2.compare(B, G, cv2.CMP_GT))
+    cv2.bitwise_and(blue_mask,
+                    cv2.compare(B, _scalar(B, math.floor(noise_floor)), cv2.CMP_GT),
+                    dst=blue_mask)
+    return dark_count, bright_count, blue_mask, cv2.countNonZero(blue_mask)
+
+
+if HAS_NUMBA:
+    # Explicit signature: compiled (or loaded from numba's on-disk cache)
+    # at import, so the first request after a worker starts does not pay
+    # for type inference and JIT.  Callers pass C-contiguous uint16 BGR.
+    @njit("Tuple((int64, int64, uint8[:, ::1], int64))"
+          "(uint16[:, :, ::1], float32, float32, float32)",
+          parallel=True, fastmath=True, cache=True)
+    def _mask_and_stats_numba(img, dark_t, bright_t, noise_floor):
+        """
+        Black-box counts and blue mask in one sweep over linear BGR uint16.
+
+        Returns (dark_count, bright_count, blue_mask, blue_count), where the
+        counts are pixels with Rec.709 luminance below dark_t / above
+        bright_t, and blue_mask is 255 where B > R, B > G and B > noise_floor.
+        """
+        h, w = img.shape[0], img.shape[1]
+        blue_mask = np.empty((h, w), dtype=np.uint8)
+        dark_count = 0
+        bright_count = 0
+        blue_count = 0
+        for y in prange(h):
+            for x in range(w):
+                b = img[y, x, 0]
+                g = img[y, x, 1]
+                r = img[y, x, 2]
+                lum = (np.float32(0.2126) * r
+                     + np.float32(0.7152) * g
+                     + np.float32(0.0722) * b)
+                if lum < dark_t:
+                    dark_count += 1
+                if lum > bright_t:
+                    bright_count += 1
+                if b > r and b > g and b > noise_floor:
+                    blue_mask[y, x] = 255
+                    blue_count += 1
+                else:
+                    blue_mask[y, x] = 0
+        return dark_count, bright_count, blue_mask, blue_count
+
+    # numba's default (workqueue) threading layer aborts the process when
+    # parallel kernels are launched from several threads at once, and the
+    # API runs analyze_image in a threadpool.  The kernel is ~1 ms, so
+    # serialising launches costs nothing noticeable.
+    _numba_launch_lock = threading.Lock()
+
+    def _mask_and_stats(img, dark_t, bright_t, noise_floor):
+        with _numba_launch_lock:
+            return _mask_and_stats_numba(img, dark_t, bright_t, noise_floor)
+else:
+    _mask_and_stats = _mask_and_stats_numpy
+
+
+def _build_overlay_webp(core_mask, contours):
     """
     Create a transparent RGBA overlay highlighting the core_mask.
     - Cyan fill (0, 220, 220, 90) inside core
-    - Green contour lines (0, 255, 0, 200)
-    Returns base64-encoded PNG with data URI prefix.
+    - Green contour lines (0, 255, 0, 200), from the caller's contours
+    Returns raw WebP bytes — a fraction of the size of the equivalent PNG
+    for a mostly transparent mask, and served as binary (no base64).
     """
-    h, w = shape_hw
-    overlay = np.zeros((h, w, 4), dtype=np.uint8)
-
-    # Semi-transparent cyan fill
-    overlay[core_mask == 255] = [0, 220, 220, 90]
+    # Semi-transparent cyan fill.  core_mask is 0/255, so ANDing it with a
+    # constant gives that constant inside the core and 0 elsewhere.
+    cyan = cv2.bitwise_and(core_mask, _scalar(core_mask, 220))
+    overlay = cv2.merge([np.zeros_like(core_mask), cyan, cyan,
+                         cv2.bitwise_and(core_mask, _scalar(core_mask, 90))])
 
     # Green contour
-    contours, _ = cv2.findContours(core_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     cv2.drawContours(overlay, contours, -1, (0, 255, 0, 200), 2)
 
-    _, enc = cv2.imencode(".png", overlay)
-    return "data:image/png;base64," + base64.b64encode(enc).decode("utf-8")
+    _, enc = cv2.imencode(".webp", overlay, _OVERLAY_WEBP_PARAMS)
+    return enc.tobytes()
 
 
 # ──────────────────────────────────────────────────────────────────────
@@ -198,24 +445,120 @@ def analyze_image(
     iso: float,
     sensitivity: float = 50,
     capture_mode: str = "jpeg",
+    high_quality: bool = False,
+    want_overlay: bool = True,
+    want_debug_image: bool = True,
+    use_cache: bool = True,
 ):
     """
     Analyse a luminol chemiluminescence image.
 
     Parameters
     ----------
-    image_bytes    : Raw file bytes.
+    image_bytes    : Raw file bytes — or any C-contiguous bytes-like buffer
+                     (memoryview, mmap, uint8 ndarray from np.fromfile),
+                     which is read in place without a copy.
     shutter_seconds: Shutter speed in seconds (e.g. 0.0167 for 1/60).
     iso            : Camera ISO.
     sensitivity    : Core-mask strictness 0-100.  Higher = stricter.
     capture_mode   : "jpeg" or "raw".
+    high_quality   : JPEG only — denoise with NL-means instead of the fast
+                     bilateral filter.  Much slower; on noisy frames the
+                     masks differ by a few percent (see debug_info).
+    want_overlay   : Encode the RGBA core-mask overlay (overlay_webp).
+    want_debug_image: Encode the legacy contour JPEG (debug_image).
+                     Either image is returned as None when not wanted.
+    use_cache      : Keep the prepared stage in the in-process LRU, so a
+                     repeat call with the same image (e.g. /preview) skips
+                     decode.  Off for one-shot callers like batch workers.
 
     Returns
     -------
-    dict  JSON-serialisable result.
+    dict  JSON-serialisable result, except "overlay_webp" which holds raw
+          bytes — the API serves those separately and sends overlay_url.
     """
-    sensitivity = max(0, min(100, float(sensitivity)))
+    image_bytes = memoryview(image_bytes).cast("B")   # flat byte view, no copy
+    if use_cache:
+        prep = _prepare_cached(image_bytes, capture_mode, high_quality)
+    else:
+        prep = _prepare(image_bytes, capture_mode, high_quality)
+    if prep["error"] is not None:
+        return dict(prep["error"])
+    return _finalize(prep, shutter_seconds, iso, sensitivity,
+                     want_overlay, want_debug_image)
+
+
+def analyze_image_file(path, *args, **kwargs):
+    """
+    analyze_image() on the contents of a file, read in the calling process.
+    Lets a process pool be handed a path instead of pickling image bytes
+    through its pipe.  Bypasses the prepared-stage cache: nothing in a
+    pool worker ever asks for the same image again.
+    """
+    return analyze_image(np.fromfile(path, dtype=np.uint8), *args,
+                         use_cache=False, **kwargs)
+
+
+def warmup():
+    """
+    Run one tiny synthetic analysis end to end, so codec setup, OpenCV's
+    thread pool and numba's parallel runtime are initialised at process
+    start rather than on the first request.  Bypasses the prepared-stage
+    cache so no dummy entry is kept.
+    """
+    img = np.zeros((16, 16, 3), dtype=np.uint8)
+    img[4:12, 4:12, 0] = 40                      # small blue patch → full path
+    _, buf = cv2.imencode(".jpg", img)
+    prep = _prepare(memoryview(buf).cast("B"), "jpeg", False)
+    if prep["error"] is None:
+        _finalize(prep, 1.0, 100.0, 50, True, True)
+
 
+def init_pool_worker():
+    """
+    Initializer for process-pool workers.  The pool already analyses one
+    image per core, so OpenCV's and numba's own thread pools are cut to a
+    single thread to avoid oversubscribing cores; then warm up.
+    """
+    cv2.setNumThreads(1)
+    if HAS_NUMBA:
+        set_num_threads(1)
+    warmup()
+
+
+# ──────────────────────────────────────────────────────────────────────
+# PREPARED-STAGE CACHE
+# ──────────────────────────────────────────────────────────────────────
+# Sections A–D depend only on the image and decode options — not on
+# sensitivity or exposure.  /preview re-sends the same image on every
+# slider move, so the prepared stage is memoised by a content hash and
+# only sections E–G run again.
+
+def _prepare_cached(image_bytes, capture_mode, high_quality):
+    key = (hashlib.blake2b(image_bytes, digest_size=16).digest(),
+           capture_mode, bool(high_quality))
+    with _prepare_cache_lock:
+        prep = _prepare_cache.get(key)
+        if prep is not None:
+            _prepare_cache.move_to_end(key)
+            return prep
+
+    prep = _prepare(image_bytes, capture_mode, high_quality)
+
+    with _prepare_cache_lock:
+        _prepare_cache[key] = prep
+        while len(_prepare_cache) > PREPARE_CACHE_SIZE:
+            _prepare_cache.popitem(last=False)
+    return prep
+
+
+def _prepare(image_bytes, capture_mode, high_quality):
+    """
+    Sections A–D: decode, downscale, denoise, black-box check, blue mask.
+
+    Returns a dict of read-only intermediates for _finalize().  On failure
+    its "error" entry holds the error response; otherwise it is None.
+    """
     # ══════════════════════════════════════════════════════════════════
     # A.  DECODE + MODE MISMATCH CHECK
     # ══════════════════════════════════════════════════════════════════
@@ -223,60 +566,104 @@ def analyze_image(
     is_jpeg_data = _is_jpeg_file(image_bytes)
 
     img_bgr_8bit = None  # only available in jpeg path
+    img_linear   = None  # only available in raw path (jpeg linearises after denoise)
 
     if capture_mode == "raw":
         # Expect RAW/DNG data
         if is_jpeg_data and not is_raw_data:
-            return _error("MODE_MISMATCH",
-                          "JPEG/PNG file uploaded but RAW mode is selected. "
-                          "Switch to JPEG mode or upload a DNG/RAW file.")
+            return _prepared_error("MODE_MISMATCH",
+                                   "JPEG/PNG file uploaded but RAW mode is selected. "
+                                   "Switch to JPEG mode or upload a DNG/RAW file.")
         img_linear, bit_depth = _decode_raw(image_bytes)
         if img_linear is None:
             # Maybe rawpy not installed or decode failed
             if not HAS_RAWPY:
-                return _error("RAW_DECODE_FAIL",
-                              "rawpy is not installed. Install it with: pip install rawpy")
-            return _error("RAW_DECODE_FAIL",
-                          "Failed to decode RAW/DNG file.")
-        sat_threshold_linear = 0.98   # near-max in linear 16-bit
+                return _prepared_error("RAW_DECODE_FAIL",
+                                       "rawpy is not installed. Install it with: pip install rawpy")
+            return _prepared_error("RAW_DECODE_FAIL",
+                                   "Failed to decode RAW/DNG file.")
+        full_hw = img_linear.shape[:2]
+        sat_threshold = math.ceil(0.98 * LINEAR_U16_MAX)   # near-max in linear 16-bit
         jpeg_caveat = False
 
     else:  # capture_mode == "jpeg"
         if is_raw_data and not is_jpeg_data:
-            return _error("MODE_MISMATCH",
-                          "RAW/DNG file uploaded but JPEG mode is selected. "
-                          "Switch to RAW mode or upload a JPEG file.")
-        img_linear, img_bgr_8bit = _decode_jpeg(image_bytes)
-        if img_linear is None:
+            return _prepared_error("MODE_MISMATCH",
+                                   "RAW/DNG file uploaded but JPEG mode is selected. "
+                                   "Switch to RAW mode or upload a JPEG file.")
+        img_bgr_8bit, full_hw = _decode_jpeg(image_bytes)
+        if img_bgr_8bit is None:
             raise ValueError("Could not decode image")
-        sat_threshold_linear = srgb_to_linear(np.array([250/255.0], dtype=np.float32))[0]
+        sat_threshold = 250                                 # sRGB code 250 and up
         jpeg_caveat = True
 
-    h, w = img_linear.shape[:2]
+    # ── Downscale to analysis resolution ──────────────────────────────
+    # INTER_AREA averages source pixels, so mean intensities are preserved;
+    # area-based metrics are scaled back to full-resolution pixels below.
+    # JPEGs may already arrive partly reduced (DCT scaling in _decode_jpeg),
+    # so the target size is derived from the full-resolution size.
+    full_h, full_w = full_hw
+    scale = 1.0
+    if max(full_h, full_w) > MAX_ANALYSIS_DIM:
+        scale = MAX_ANALYSIS_DIM / max(full_h, full_w)
+    dsize = (max(1, round(full_w * scale)), max(1, round(full_h * scale)))
+
+    # Averaging would pull small clipped highlights below the saturation
+    # threshold, so max and saturation are taken from the blue channel at
+    # decode resolution first (see _footprint_stats) — whether or not the
+    # image is then downscaled, so both metrics mean the same at any size.
+    if img_bgr_8bit is not None:
+        B_max, sat_frac = _footprint_stats(
+            cv2.extractChannel(img_bgr_8bit, 0), dsize, sat_threshold)
+        if img_bgr_8bit.shape[1::-1] != dsize:
+            img_bgr_8bit = cv2.resize(img_bgr_8bit, dsize, interpolation=cv2.INTER_AREA)
+    else:
+        B_max, sat_frac = _footprint_stats(
+            cv2.extractChannel(img_linear, 0), dsize, sat_threshold)
+        if img_linear.shape[1::-1] != dsize:
+            img_linear = cv2.resize(img_linear, dsize, interpolation=cv2.INTER_AREA)
+
+    h, w = dsize[1], dsize[0]
+    area_scale = (full_h * full_w) / (h * w)   # analysis px → full-resolution px
 
     # ══════════════════════════════════════════════════════════════════
     # B.  MILD DENOISE (on linear data)
     # ══════════════════════════════════════════════════════════════════
-    # For jpeg path we can denoise the 8-bit then re-linearise.
-    # For raw path we do a mild bilateral on the float data.
+    # For jpeg path we can denoise the 8-bit then re-linearise.  The masks
+    # below only threshold, so a bilateral filter is enough; NL-means is
+    # orders of magnitude slower and kept behind high_quality.
+    # For raw path we do a mild gaussian on the uint16 linear data.
+    # The bilateral filter is not a drop-in match for NL-means: on noisy
+    # frames it leaves core/blue areas a few percent larger and means lower,
+    # so the denoiser used is reported in debug_info.
     if img_bgr_8bit is not None:
-        dn_bgr = cv2.fastNlMeansDenoisingColored(img_bgr_8bit, None, 3, 3, 7, 21)
-        dn_rgb = cv2.cvtColor(dn_bgr, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
-        img_linear_dn = srgb_to_linear(dn_rgb)
+        if high_quality:
+            dn_bgr = cv2.fastNlMeansDenoisingColored(img_bgr_8bit, None, 3, 3, 7, 21)
+            denoiser = "nlmeans(3,3,7,21)"
+        else:
+            dn_bgr = cv2.bilateralFilter(img_bgr_8bit, 5, 25, 5)
+            denoiser = "bilateral(5,25,5)"
+        img_linear_dn = _SRGB8_TO_LIN16[dn_bgr]    # linear BGR, one gather
     else:
-        # RAW path: simple gaussian blur as mild denoise on float
+        # RAW path: simple gaussian blur as mild denoise on uint16
         img_linear_dn = cv2.GaussianBlur(img_linear, (5, 5), 0.8)
+        denoiser = "gaussian(5,0.8)"
 
     # ══════════════════════════════════════════════════════════════════
     # C.  BLACK-BOX CHECK
     # ══════════════════════════════════════════════════════════════════
-    lum = (0.2126 * img_linear_dn[:, :, 0]
-         + 0.7152 * img_linear_dn[:, :, 1]
-         + 0.0722 * img_linear_dn[:, :, 2])
-
-    total_px   = lum.size
-    pct_dark   = float(np.sum(lum < LINEAR_DARK_THRESHOLD) / total_px)
-    pct_bright = float(np.sum(lum > LINEAR_BRIGHT_THRESHOLD) / total_px)
+    # Luminance counts and the blue mask (section D) come from one fused
+    # pass over the linear image — no full-size temporaries.
+    dark_count, bright_count, blue_mask, blue_count = _mask_and_stats(
+        img_linear_dn,
+        np.float32(LINEAR_DARK_THRESHOLD * LINEAR_U16_MAX),
+        np.float32(LINEAR_BRIGHT_THRESHOLD * LINEAR_U16_MAX),
+        np.float32(BLUE_NOISE_FLOOR * LINEAR_U16_MAX),
+    )
+
+    total_px   = h * w
+    pct_dark   = float(dark_count / total_px)
+    pct_bright = float(bright_count / total_px)
     is_black_box = (pct_dark > BB_MIN_DARK_RATIO) and (pct_bright < BB_MAX_BRIGHT_RATIO)
 
     bb_debug = {
@@ -286,76 +673,128 @@ def analyze_image(
     }
 
     if not is_black_box:
-        return {
+        return {"error": {
             "status":      "error",
             "error_type":  "BLACKBOX_NOT_DETECTED",
             "message":     "Black box not detected — surrounding conditions not ideal.",
             "debug_info":  bb_debug,
             "metrics":     {},
             "debug_image": None,
-            "overlay_png_base64": None,
+            "overlay_webp": None,
             "capture_mode": capture_mode,
-        }
+        }}
 
     # ══════════════════════════════════════════════════════════════════
     # D.  BLUE REGION — all pixels where blue is dominant
     # ══════════════════════════════════════════════════════════════════
-    R = img_linear_dn[:, :, 0]
-    G = img_linear_dn[:, :, 1]
-    B = img_linear_dn[:, :, 2]
+    # Contiguous copies: OpenCV's masked reductions in _finalize would
+    # otherwise copy a strided channel view internally on every call.
+    B  = cv2.extractChannel(img_linear_dn, 0)
+
+    # Blue mask (built in section C): every pixel where blue channel exceeds
+    # both red and green and is above BLUE_NOISE_FLOOR.  No component
+    # selection — we keep ALL blue-dominant pixels across the whole image.
+    blue_area = int(round(blue_count * area_scale))
+    blue_detected = blue_area > MIN_BLUE_AREA_PX
 
-    # Noise floor: ignore pixels that are essentially black
-    noise_floor = 0.002
+    # Blue-region values for the sensitivity percentile.  Independent of
+    # sensitivity, so gathered once here rather than on every slider move.
+    b_in_blue = B[blue_mask == 255]
 
-    # Blue mask: every pixel where blue channel exceeds both red and green
-    # and is above the noise floor.  No component selection — we keep ALL
-    # blue-dominant pixels across the whole image.
-    blue_mask = ((B > R) & (B > G) & (B > noise_floor)).astype(np.uint8) * 255
+    return {
+        "error":                None,
+        "capture_mode":         capture_mode,
+        "img_bgr_8bit":         img_bgr_8bit,
+        "img_linear":           img_linear,
+        "B":                    B,
+        "B_max":                B_max,
+        "sat_frac":             sat_frac,
+        "b_in_blue":            b_in_blue,
+        "blue_mask":            blue_mask,
+        "blue_area":            blue_area,
+        "blue_detected":        blue_detected,
+        "bb_debug":             bb_debug,
+        "jpeg_caveat":          jpeg_caveat,
+        "scale":                scale,
+        "denoiser":             denoiser,
+        "area_scale":           area_scale,
+        "shape_hw":             (h, w),
+    }
 
-    blue_area = int(cv2.countNonZero(blue_mask))
-    blue_detected = blue_area > MIN_BLUE_AREA_PX
+
+def _finalize(prep, shutter_seconds, iso, sensitivity,
+               want_overlay, want_debug_image):
+    """Sections E–G: sensitivity cutoff, metrics and response images."""
+    sensitivity = max(0, min(100, float(sensitivity)))
+
+    capture_mode         = prep["capture_mode"]
+    img_bgr_8bit         = prep["img_bgr_8bit"]
+    img_linear           = prep["img_linear"]
+    B                    = prep["B"]
+    B_max                = prep["B_max"]
+    sat_frac             = prep["sat_frac"]
+    b_in_blue            = prep["b_in_blue"]
+    blue_mask            = prep["blue_mask"]
+    blue_area            = prep["blue_area"]
+    blue_detected        = prep["blue_detected"]
+    bb_debug             = prep["bb_debug"]
+    jpeg_caveat          = prep["jpeg_caveat"]
+    scale                = prep["scale"]
+    denoiser             = prep["denoiser"]
+    area_scale           = prep["area_scale"]
+    h, w                 = prep["shape_hw"]
 
     # ══════════════════════════════════════════════════════════════════
     # E.  SENSITIVITY SLIDER — simple brightness cutoff
     #     slider=0  → keep all blue pixels (no cutoff)
     #     slider=100 → keep only the top 1% brightest blue pixels
     # ══════════════════════════════════════════════════════════════════
-    b_in_blue = B[blue_mask == 255]
-
     if b_in_blue.size > 0 and sensitivity > 0:
         # Map slider 0-100 → percentile 0-99 of the blue region's brightness
         cutoff_pct = sensitivity * 0.99          # 0→0th pctl, 100→99th pctl
-        cutoff = float(np.percentile(b_in_blue, cutoff_pct))
-        core_mask = ((blue_mask == 255) & (B >= cutoff)).astype(np.uint8) * 255
+        cutoff = _percentile(b_in_blue, cutoff_pct)
+        # B is integer-valued, so B >= cutoff  ⇔  B >= ceil(cutoff)
+        core_mask = cv2.bitwise_and(
+            cv2.compare(B, _scalar(B, math.ceil(cutoff)), cv2.CMP_GE), blue_mask)
     else:
         core_mask = blue_mask.copy()             # slider=0: keep everything
 
-    core_area = int(cv2.countNonZero(core_mask))
+    core_area_an = int(cv2.countNonZero(core_mask))          # analysis px
+    core_area    = int(round(core_area_an * area_scale))      # full-res px
 
     # ══════════════════════════════════════════════════════════════════
     # F.  METRICS — computed inside core_mask in linear space
     # ══════════════════════════════════════════════════════════════════
-    b_core = B[core_mask == 255]
-
-    mean_lin   = float(np.mean(b_core))               if b_core.size > 0 else 0.0
-    integ_lin  = float(np.sum(b_core))                 if b_core.size > 0 else 0.0
-    max_lin    = float(np.max(b_core))                 if b_core.size > 0 else 0.0
-    p99_5_lin  = float(np.percentile(b_core, 99.5))    if b_core.size > 0 else 0.0
-
-    # Saturation ratio (bit-depth aware)
-    if b_core.size > 0:
-        sat_count  = int(np.sum(b_core >= sat_threshold_linear))
-        sat_ratio  = float(sat_count / core_area) if core_area > 0 else 0.0
+    # Mean / max / saturation go through OpenCV's masked reductions; the
+    # core pixels are only gathered into a scratch array for the percentile.
+    # B is uint16 (see LINEAR_U16_MAX); only the scalars are rescaled.
+    #
+    # Mean and percentile are measured on the denoised analysis image.  Max
+    # and saturation are measured on the blue channel as decoded, before
+    # downscale and denoise, through the maps built in _prepare: the max
+    # over core pixels' footprints, and the saturated fraction of those
+    # footprints.  Approximate in that the core mask selecting them is at
+    # analysis resolution, and a JPEG's DCT-domain reduction averages too.
+    if core_area_an > 0:
+        mean_lin      = float(cv2.mean(B, mask=core_mask)[0]) / LINEAR_U16_MAX
+        integ_lin     = mean_lin * core_area_an * area_scale
+        p99_5_lin     = _percentile(B[core_mask == 255], 99.5) / LINEAR_U16_MAX
+
+        _, max_src, _, _ = cv2.minMaxLoc(B_max, mask=core_mask)
+        sat_ratio = float(cv2.mean(sat_frac, mask=core_mask)[0])
     else:
-        sat_count  = 0
-        sat_ratio  = 0.0
+        mean_lin = integ_lin = p99_5_lin = 0.0
+        max_src = 0.0
+        sat_ratio = 0.0
 
-    # Legacy max_blue_raw (8-bit B channel in sRGB — only valid for jpeg path)
-    if img_bgr_8bit is not None and core_area > 0:
-        _, max_raw, _, _ = cv2.minMaxLoc(img_bgr_8bit[:, :, 0], mask=core_mask)
-        max_raw = float(max_raw)
+    if img_bgr_8bit is not None:
+        # B_max holds 8-bit sRGB code values; max_blue_raw is the legacy
+        # 8-bit B channel maximum (only valid for jpeg path)
+        max_raw = float(max_src)
+        max_lin = float(_SRGB8_TO_LIN16[int(max_src)]) / LINEAR_U16_MAX
     else:
-        max_raw = float(max_lin * 255)  # approximate for RAW or empty core
+        max_lin = float(max_src) / LINEAR_U16_MAX
+        max_raw = float(max_lin * 255)  # approximate for RAW
 
     # ── Normalisation ─────────────────────────────────────────────────
     t   = float(shutter_seconds) if shutter_seconds else 0.0
@@ -401,20 +840,24 @@ def analyze_image(
     if core_area < 200:
         warnings.append("Core area very small — results may be noisy.")
 
-    # ── Debug overlay (JPEG with green contours — legacy) ─────────────
-    if img_bgr_8bit is not None:
-        debug_vis = img_bgr_8bit.copy()
-    else:
-        # For RAW, create an 8-bit visualisation
-        vis = np.clip(img_linear * 255, 0, 255).astype(np.uint8)
-        debug_vis = cv2.cvtColor(vis, cv2.COLOR_RGB2BGR)
-    contours, _ = cv2.findContours(core_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cv2.drawContours(debug_vis, contours, -1, (0, 255, 0), 2)
-    _, enc = cv2.imencode(".jpg", debug_vis)
-    debug_b64 = "data:image/jpeg;base64," + base64.b64encode(enc).decode("utf-8")
+    # Contours are traced once and drawn on whichever images are wanted
+    if want_debug_image or want_overlay:
+        contours, _ = cv2.findContours(core_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    # ── RGBA overlay PNG (transparent, for live preview) ──────────────
-    overlay_b64 = _build_overlay_png(core_mask, (h, w))
+    # ── Debug overlay (JPEG with green contours — legacy) ─────────────
+    debug_b64 = None
+    if want_debug_image:
+        if img_bgr_8bit is not None:
+            debug_vis = img_bgr_8bit.copy()
+        else:
+            # For RAW, create an 8-bit visualisation
+            debug_vis = cv2.convertScaleAbs(img_linear, alpha=255.0 / LINEAR_U16_MAX)
+        cv2.drawContours(debug_vis, contours, -1, (0, 255, 0), 2)
+        _, enc = cv2.imencode(".jpg", debug_vis, _DEBUG_JPEG_PARAMS)
+        debug_b64 = "data:image/jpeg;base64," + base64.b64encode(enc).decode("utf-8")
+
+    # ── RGBA overlay WebP (transparent, for live preview) ─────────────
+    overlay_webp = _build_overlay_webp(core_mask, contours) if want_overlay else None
 
     return {
         "status":             "success",
@@ -428,9 +871,11 @@ def analyze_image(
             "blue_area_px":      blue_area,
             "core_area_px":      core_area,
             "sensitivity_used":  float(sensitivity),
+            "analysis_scale":    float(scale),
+            "denoiser":          denoiser,
         },
         "debug_image":        debug_b64,
-        "overlay_png_base64": overlay_b64,
+        "overlay_webp":       overlay_webp,
     }
 
 
@@ -444,5 +889,10 @@ def _error(error_type, message):
         "debug_info":         {},
         "metrics":            {},
         "debug_image":        None,
-        "overlay_png_base64": None,
+        "overlay_webp":       None,
     }
+
+
+def _prepared_error(error_type, message):
+    """Error result in the shape _prepare() returns (cached like a success)."""
+    return {"error": _error(error_type, message)}
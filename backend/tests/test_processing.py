@@ -0,0 +1,127 @@
+"""
+Checks for the processing paths that must agree exactly with a reference:
+the numba kernel vs its OpenCV fallback, _percentile vs np.percentile,
+DCT scale selection, the footprint max/saturation maps and the EXIF
+orientation mapping.
+"""
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+import processing as p
+
+
+def _thresholds():
+    return (np.float32(p.LINEAR_DARK_THRESHOLD * p.LINEAR_U16_MAX),
+            np.float32(p.LINEAR_BRIGHT_THRESHOLD * p.LINEAR_U16_MAX),
+            np.float32(p.BLUE_NOISE_FLOOR * p.LINEAR_U16_MAX))
+
+
+def _mask_test_images():
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 65536, (37, 53, 3), dtype=np.uint16)]
+    # LUT-linearised 8-bit images, as the JPEG path produces
+    for _ in range(10):
+        images.append(p._SRGB8_TO_LIN16[rng.integers(0, 256, (41, 29, 3), dtype=np.uint8)])
+    return images
+
+
+@pytest.mark.skipif(not p.HAS_NUMBA, reason="numba not installed")
+@pytest.mark.parametrize("img", _mask_test_images())
+def test_mask_kernel_matches_numpy_fallback(img):
+    args = (img, *_thresholds())
+    dark_n, bright_n, mask_n, count_n = p._mask_and_stats_numba(*args)
+    dark_f, bright_f, mask_f, count_f = p._mask_and_stats_numpy(*args)
+    assert (dark_n, bright_n, count_n) == (dark_f, bright_f, count_f)
+    np.testing.assert_array_equal(mask_n, mask_f)
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 1000, 4097])
+@pytest.mark.parametrize("q", [0.0, 12.5, 50.0, 97.02, 99.5, 100.0])
+def test_percentile_matches_numpy_on_uint16(size, q):
+    rng = np.random.default_rng(size)
+    values = rng.integers(0, 65536, size, dtype=np.uint16)
+    assert p._percentile(values, q) == float(np.percentile(values, q))
+
+
+@pytest.mark.parametrize("width, height, expected", [
+    (1000, 800, (1, 1)),      # already under the cap
+    (2048, 1536, (1, 2)),     # 1/2 lands exactly on the cap
+    (4032, 3024, (1, 2)),     # 1/4 would give 1008 < 1024
+    (3024, 4032, (1, 2)),     # portrait: the long edge decides
+    (8192, 6144, (1, 8)),
+    (8191, 6144, (1, 8)),     # 1/8 rounds up to 1024
+    (8180, 6144, (1, 4)),     # 1/8 would give 1023
+])
+def test_dct_scaling_factor(width, height, expected):
+    factor = p._dct_scaling_factor(width, height, p._CV2_REDUCED_FLAGS,
+                                   p.MAX_ANALYSIS_DIM)
+    assert factor == expected
+
+
+@pytest.mark.parametrize("src_hw, dsize", [
+    ((64, 48), (12, 16)),
+    ((100, 75), (30, 40)),
+    ((333, 250), (77, 103)),
+    ((31, 17), (5, 9)),
+])
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_footprint_max_never_underestimates(src_hw, dsize, dtype):
+    rng = np.random.default_rng(1)
+    channel = rng.integers(0, np.iinfo(dtype).max + 1, src_hw, dtype=dtype)
+    max_map, _ = p._footprint_stats(channel, dsize, 1)
+
+    src_h, src_w = src_hw
+    dst_w, dst_h = dsize
+    assert max_map.shape == (dst_h, dst_w)
+    for y in range(dst_h):
+        r0, r1 = y * src_h // dst_h, -(-(y + 1) * src_h // dst_h)
+        for x in range(dst_w):
+            c0, c1 = x * src_w // dst_w, -(-(x + 1) * src_w // dst_w)
+            # At least the footprint's max, at most one extra row/column out
+            assert max_map[y, x] >= channel[r0:r1, c0:c1].max()
+            assert max_map[y, x] <= channel[max(r0 - 1, 0):r1 + 1,
+                                             max(c0 - 1, 0):c1 + 1].max()
+
+
+def test_footprint_saturated_fraction():
+    rng = np.random.default_rng(2)
+    channel = rng.integers(0, 256, (64, 48), dtype=np.uint8)
+    _, sat_frac = p._footprint_stats(channel, (12, 16), 250)
+
+    assert sat_frac.dtype == np.float32
+    assert sat_frac.min() >= 0 and sat_frac.max() <= 1
+    # 4×4 footprints tile the image, so the mean is the image's fraction
+    assert sat_frac.mean() == pytest.approx(np.mean(channel >= 250), abs=1e-6)
+
+
+def test_footprint_stats_without_resize():
+    channel = np.array([[10, 250], [255, 0]], dtype=np.uint8)
+    max_map, sat_frac = p._footprint_stats(channel, (2, 2), 250)
+    np.testing.assert_array_equal(max_map, channel)
+    np.testing.assert_array_equal(sat_frac, [[0, 1], [1, 0]])
+
+
+@pytest.mark.parametrize("orientation, transpose", [
+    (1, None),
+    (2, Image.Transpose.FLIP_LEFT_RIGHT),
+    (3, Image.Transpose.ROTATE_180),
+    (4, Image.Transpose.FLIP_TOP_BOTTOM),
+    (5, Image.Transpose.TRANSPOSE),
+    (6, Image.Transpose.ROTATE_270),
+    (7, Image.Transpose.TRANSVERSE),
+    (8, Image.Transpose.ROTATE_90),
+])
+def test_exif_orientation_matches_pillow(orientation, transpose):
+    img = np.arange(5 * 7, dtype=np.uint8).reshape(5, 7)
+    expected = img if transpose is None else np.asarray(Image.fromarray(img).transpose(transpose))
+    np.testing.assert_array_equal(p._apply_exif_orientation(img, orientation), expected)
+
+
+def test_one_pixel_jpeg():
+    _, buf = cv2.imencode(".jpg", np.zeros((1, 1, 3), dtype=np.uint8))
+    result = p.analyze_image(buf, 1 / 60, 100)
+    assert result["status"] == "success"
+    assert result["metrics"]["core_area_px"] == 0
@@ -6,6 +6,11 @@ import { QueueItem } from './components/QueueItem';
 
 const API_URL = 'http://localhost:8000';
 
+/* The backend serves overlays separately and returns a path relative to the API */
+const withOverlayUrl = (data) => (
+    data.overlay_url ? { ...data, overlay_url: `${API_URL}${data.overlay_url}` } : data
+);
+
 /* Default acquisition settings */
 const DEFAULT_SETTINGS = {
     t: 0.0167,          // 1/60 s
@@ -23,6 +28,8 @@ function App() {
     const [isProcessing, setIsProcessing] = useState(false);
     const [isDragOver, setIsDragOver] = useState(false);
     const fileInputRef = useRef(null);
+    const uploadTokens = useRef({});        // item id → /upload token
+    const overlayRefreshed = useRef({});    // item id → overlay refresh already tried
 
     const doneCount = queue.filter((i) => i.status === 'success' && !i.dirty).length;
     const dirtyCount = queue.filter((i) => i.dirty).length;
@@ -62,10 +69,14 @@ function App() {
 
     const clearQueue = () => {
         queue.forEach((i) => URL.revokeObjectURL(i.preview));
+        uploadTokens.current = {};
+        overlayRefreshed.current = {};
         setQueue([]);
     };
 
     const removeItem = (id) => {
+        delete uploadTokens.current[id];
+        delete overlayRefreshed.current[id];
         setQueue((prev) => prev.filter((i) => i.id !== id));
     };
 
@@ -82,10 +93,11 @@ function App() {
         );
     };
 
-    /* ─── Build FormData for a queue item ─── */
-    const buildFormData = useCallback((item, sensitivityOverride) => {
+    /* ─── Build FormData for a queue item (by upload token when given) ─── */
+    const buildFormData = useCallback((item, sensitivityOverride, token) => {
         const formData = new FormData();
-        formData.append('image', item.file);
+        if (token) formData.append('token', token);
+        else formData.append('image', item.file);
 
         const t = item.overrides?.t || item.globalSettingsUsed?.t || globalSettings.t || 0;
         const iso = item.overrides?.iso || item.globalSettingsUsed?.iso || globalSettings.iso || 0;
@@ -98,6 +110,28 @@ function App() {
         return { formData, usedSettings: { t, iso, sensitivity: sens, captureMode } };
     }, [globalSettings, captureMode]);
 
+    /* ─── Upload each image once; /analyze and /preview then send a token ─── */
+    const postItem = useCallback(async (path, item, sensitivityOverride) => {
+        for (let attempt = 0; ; attempt++) {
+            let token = uploadTokens.current[item.id];
+            if (!token) {
+                const upload = new FormData();
+                upload.append('image', item.file);
+                token = (await axios.post(`${API_URL}/upload`, upload)).data.token;
+                uploadTokens.current[item.id] = token;
+            }
+            const { formData, usedSettings } = buildFormData(item, sensitivityOverride, token);
+            try {
+                const { data } = await axios.post(`${API_URL}${path}`, formData);
+                return { data: withOverlayUrl(data), usedSettings };
+            } catch (err) {
+                // Token expired on the server → upload again, once
+                if (err.response?.status !== 404 || attempt > 0) throw err;
+                delete uploadTokens.current[item.id];
+            }
+        }
+    }, [buildFormData]);
+
     /* ─── Processing (selective: only pending + dirty) ─── */
     const processQueue = async () => {
         if (isProcessing) return;
@@ -122,12 +156,11 @@ function App() {
 
         update({ status: 'processing', progress: 10, dirty: false });
         setTimeout(() => update({ progress: 25 }), 300);
-
-        const { formData, usedSettings } = buildFormData(item);
+        delete overlayRefreshed.current[item.id];
 
         try {
             setTimeout(() => update({ progress: 55 }), 600);
-            const { data } = await axios.post(`${API_URL}/analyze`, formData);
+            const { data, usedSettings } = await postItem('/analyze', item);
             update({ progress: 85 });
             await new Promise((r) => setTimeout(r, 200));
 
@@ -155,9 +188,8 @@ function App() {
             const item = queue.find((i) => i.id === itemId);
             if (!item) return;
 
-            const { formData } = buildFormData(item, sensitivityValue);
             try {
-                const { data } = await axios.post(`${API_URL}/preview`, formData);
+                const { data } = await postItem('/preview', item, sensitivityValue);
                 setQueue((prev) => prev.map((i) =>
                     i.id === itemId
                         ? {
@@ -171,7 +203,34 @@ function App() {
                 console.error('Preview failed:', err);
             }
         }, 250);
-    }, [queue, buildFormData]);
+    }, [queue, postItem]);
+
+    /* ─── Overlay gone on the server (upload expired) → fetch a fresh one ─── */
+    const refreshOverlay = useCallback(async (itemId, sensitivityValue) => {
+        const item = queue.find((i) => i.id === itemId);
+        if (!item) return;
+        // Once per item until an overlay loads again: if the fresh one fails
+        // too (several backend workers, no WebP support) retrying would loop
+        if (overlayRefreshed.current[itemId]) {
+            console.error('Overlay failed to load again after a refresh; not retrying.');
+            return;
+        }
+        overlayRefreshed.current[itemId] = true;
+        try {
+            const { data } = await postItem('/preview', item, sensitivityValue);
+            setQueue((prev) => prev.map((i) =>
+                i.id === itemId && i.result
+                    ? { ...i, result: { ...i.result, overlay_url: data.overlay_url } }
+                    : i
+            ));
+        } catch (err) {
+            console.error('Overlay refresh failed:', err);
+        }
+    }, [queue, postItem]);
+
+    const overlayLoaded = useCallback((itemId) => {
+        delete overlayRefreshed.current[itemId];
+    }, []);
 
     /* ─── Export ─── */
     const exportCSV = () => {
@@ -359,6 +418,8 @@ function App() {
                                         onRetry={retryItem}
                                         onUpdateSettings={updateItemSettings}
                                         onPreview={onPreview}
+                                        onOverlayError={refreshOverlay}
+                                        onOverlayLoad={overlayLoaded}
                                         debugMode={debugMode}
                                         globalSensitivity={globalSettings.sensitivity}
                                         captureMode={captureMode}
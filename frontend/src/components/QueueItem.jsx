@@ -50,7 +50,7 @@ const fmt = (v, d = 4) => v != null ? Number(v).toFixed(d) : '—';
 const fmtInt = (v) => v != null ? Number(v).toLocaleString() : '—';
 
 /* ─── Queue Item Card ─── */
-export function QueueItem({ item, onRemove, onRetry, debugMode, onUpdateSettings, onPreview, globalSensitivity, captureMode }) {
+export function QueueItem({ item, onRemove, onRetry, debugMode, onUpdateSettings, onPreview, onOverlayError, onOverlayLoad, globalSensitivity, captureMode }) {
     const [expanded, setExpanded] = useState(false);
     const [localOverrides, setLocalOverrides] = useState(item.overrides || {});
 
@@ -173,16 +173,18 @@ export function QueueItem({ item, onRemove, onRetry, debugMode, onUpdateSettings
                             <img src={item.preview} className="max-w-full max-h-[280px] object-contain" alt="" />
 
                             {/* Core mask overlay — always shown when available */}
-                            {result?.overlay_png_base64 && (
+                            {result?.overlay_url && (
                                 <img
-                                    src={result.overlay_png_base64}
+                                    src={result.overlay_url}
                                     className="absolute inset-0 w-full h-full object-contain pointer-events-none"
                                     alt=""
+                                    onError={() => onOverlayError?.(item.id, effectiveSensitivity)}
+                                    onLoad={() => onOverlayLoad?.(item.id)}
                                 />
                             )}
 
                             {/* Debug overlay (legacy contour JPEG) */}
-                            {debugMode && result?.debug_image && !result?.overlay_png_base64 && (
+                            {debugMode && result?.debug_image && !result?.overlay_url && (
                                 <div className="absolute inset-0 flex items-center justify-center">
                                     <img src={result.debug_image} className="absolute inset-0 w-full h-full object-contain opacity-50 mix-blend-screen" alt="" />
                                     <div className="absolute bottom-2 right-2 badge-processing !text-[9px]">
@@ -192,7 +194,7 @@ export function QueueItem({ item, onRemove, onRetry, debugMode, onUpdateSettings
                             )}
 
                             {/* Overlay label */}
-                            {result?.overlay_png_base64 && (
+                            {result?.overlay_url && (
                                 <div className="absolute bottom-2 right-2 badge-processing !text-[9px] !bg-surface-0/70">
                                     <Eye size={9} /> Core Mask
                                 </div>